@@ -1,15 +1,29 @@
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse
+import aiofiles
+import aiofiles.os
 import markdown
+import orjson
 from dotenv import load_dotenv
 import os
-import secrets
+import base64
+import asyncio
+import string
 import hashlib
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+import hmac
+import time
+from collections import deque
+from functools import lru_cache
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi.security.utils import get_authorization_scheme_param
 from pydantic import BaseModel
 from typing import List
-from datetime import datetime, timedelta
+from datetime import timedelta
 from jose import JWTError, jwt
+from cachetools import TTLCache
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 
 # ================================
 # RATE LIMITING IMPORTS (slowapi)
@@ -17,7 +31,6 @@ from jose import JWTError, jwt
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-from fastapi.responses import JSONResponse
 from slowapi.middleware import SlowAPIMiddleware
 
 load_dotenv()
@@ -28,13 +41,25 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+_EXPIRE_SECONDS = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+# Redis >= 6.2 (for GETDEL). Optional: without it rate limits and challenge
+# state fall back to per-process memory, which is fine for a single worker.
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 if not SECRET_KEY:
     raise RuntimeError("SECRET_KEY is not set in environment variables")
 
 # ================================
 # RATE LIMITER SETUP
 # ================================
-limiter = Limiter(key_func=get_remote_address)
+# Counters live in Redis so every worker process shares the same limits. If
+# Redis is unreachable (e.g. plain `uvicorn main:app` in local dev) slowapi
+# falls back to per-process in-memory counters instead of failing requests.
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=REDIS_URL,
+    strategy="moving-window",
+    in_memory_fallback_enabled=True,
+)
 
 # ================================
 # FASTAPI APP
@@ -43,6 +68,9 @@ app = FastAPI(
     title=os.getenv("APP_TITLE", "Interactive API Learning Platform"),
     description="A secure educational API to teach how APIs work",
     version=os.getenv("APP_VERSION", "1.2.0"),
+    # ORJSONResponse is deprecated from FastAPI 0.131 (requirements.txt pins
+    # below it); drop this once we move to Pydantic-native serialization.
+    default_response_class=ORJSONResponse,
     openapi_tags=[
         {"name": "Authentication", "description": "Login and token operations"},
         {"name": "Lessons", "description": "Endpoints for teaching GET and POST"},
@@ -58,7 +86,7 @@ app.add_middleware(SlowAPIMiddleware)
 # Custom rate-limit error handler
 @app.exception_handler(RateLimitExceeded)
 def rate_limit_handler(request: Request, exc: RateLimitExceeded):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=429,
         content={"detail": "Rate limit exceeded. Slow down!"}
     )
@@ -96,79 +124,147 @@ fake_users_db = {
     }
 }
 
+@lru_cache(maxsize=1024)
+def _user_by_name(name: str) -> dict | None:
+    # Call _user_by_name.cache_clear() whenever fake_users_db is modified.
+    return fake_users_db.get(name)
+
 lessons_db = [
     Lesson(id=1, title="GET Basics", description="Learn how GET requests work", task="Fetch this lesson using GET", endpoint="/lessons"),
     Lesson(id=2, title="POST Basics", description="Learn how POST requests work", task="Create a new lesson using POST", endpoint="/lessons"),
     Lesson(id=3, title="Auth", description="Learn authentication", task="Login and access protected route", endpoint="/protected")
 ]
 
+def _encode_lessons() -> bytes:
+    return orjson.dumps([lesson.model_dump() for lesson in lessons_db])
+
+# Encoded body for GET /lessons, rebuilt by create_lesson after each append.
+_lessons_json_cache: bytes = _encode_lessons()
+
 # ================================
 # SECURITY
 # ================================
+# Only used to describe bearer auth in the OpenAPI docs; get_current_user reads
+# the Authorization header itself to avoid an extra dependency per request.
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+BEARER_SECURITY = {"security": [{oauth2_scheme.scheme_name: []}]}
+
+# Decoded tokens are cached briefly so repeat requests skip the HMAC check.
+# Entries are keyed by a keyed BLAKE2b hash of the token and never outlive its
+# "exp". The cache key is not a signature; tokens are still verified as HS256.
+# TTLCache is not thread-safe, so it is only touched from async code on the
+# event loop (get_current_user is async for this reason).
+JWT_CACHE_TTL_SECONDS = 30
+_CACHE_KEY = SECRET_KEY.encode()[:64]
+_jwt_cache = TTLCache(maxsize=10000, ttl=JWT_CACHE_TTL_SECONDS)
+
+
+# HS256 tokens are signed directly with hmac; the header never changes so it is
+# encoded once here. Other algorithms still go through python-jose.
+_KEY_BYTES = SECRET_KEY.encode()
+_HEADER_B64 = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b"=")
+
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    if expires_delta is None:
+        expire = int(time.time()) + _EXPIRE_SECONDS
+    else:
+        expire = int(time.time()) + int(expires_delta.total_seconds())
+    to_encode["exp"] = expire
+    if ALGORITHM != "HS256":
+        return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+    signing_input = _HEADER_B64 + b"." + _b64url(orjson.dumps(to_encode))
+    signature = hmac.new(_KEY_BYTES, signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + _b64url(signature)).decode("ascii")
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(request: Request):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    scheme, token = get_authorization_scheme_param(request.headers.get("authorization"))
+    if scheme.lower() != "bearer" or not token:
+        raise credentials_exception
+
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16, key=_CACHE_KEY).digest()
+    cached = _jwt_cache.get(cache_key)
+    if cached is not None:
+        user, expire = cached
+        if expire > time.time():
+            return user
+        _jwt_cache.pop(cache_key, None)
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        if username is None:
+        expire = payload.get("exp")
+        if username is None or expire is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
 
-    user = fake_users_db.get(username)
+    if expire <= time.time():
+        raise credentials_exception
+
+    user = _user_by_name(username)
     if user is None:
         raise credentials_exception
+
+    # Only successfully validated tokens are cached.
+    _jwt_cache[cache_key] = (user, expire)
     return user
 
 # ================================
 # AUTH ENDPOINTS (RATE LIMITED)
 # ================================
+_DUMMY_PASSWORD = b"x" * 64
+
 @app.post("/token", response_model=Token, tags=["Authentication"])
 @limiter.limit("5/minute")  # 5 login attempts per minute per IP
 def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
     user = fake_users_db.get(form_data.username)
-    if not user or user["hashed_password"] != form_data.password:
+    stored_password = user["hashed_password"] if user else None
+    # Unknown users (or users without a password) are compared against
+    # _DUMMY_PASSWORD so every path does the same constant-time work.
+    target = stored_password.encode() if stored_password else _DUMMY_PASSWORD
+    ok = hmac.compare_digest(target, form_data.password.encode()) and bool(stored_password)
+    if not ok:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
-    access_token = create_access_token(
-        data={"sub": user["username"]},
-        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
-    )
+    access_token = create_access_token(data={"sub": user["username"]})
     return {"access_token": access_token, "token_type": "bearer"}
 
 # ================================
 # LESSON ENDPOINTS (RATE LIMITED)
 # ================================
-@app.get("/lessons", response_model=List[Lesson], tags=["Lessons"])
+@app.get("/lessons", responses={200: {"model": List[Lesson]}}, tags=["Lessons"])
 @limiter.limit("30/minute")
-def get_lessons(request: Request):
-    return lessons_db
+async def get_lessons(request: Request):
+    return Response(content=_lessons_json_cache, media_type="application/json")
 
 
-@app.post("/lessons", response_model=Lesson, tags=["Lessons"])
+@app.post("/lessons", responses={200: {"model": Lesson}}, tags=["Lessons"], openapi_extra=BEARER_SECURITY)
 @limiter.limit("10/minute")
-def create_lesson(request: Request, lesson: Lesson, user=Depends(get_current_user)):
+async def create_lesson(request: Request, lesson: Lesson, user=Depends(get_current_user)):
+    global _lessons_json_cache
+    # Runs on the event loop like get_lessons, so the append and rebuild can't
+    # interleave with a read of the cache.
     lessons_db.append(lesson)
-    return lesson
+    _lessons_json_cache = _encode_lessons()
+    return lesson.model_dump()
 
 
-@app.get("/protected", tags=["Protected"])
+@app.get("/protected", tags=["Protected"], openapi_extra=BEARER_SECURITY)
 @limiter.limit("20/minute")
-def protected_route(request: Request, user=Depends(get_current_user)):
+async def protected_route(request: Request, user=Depends(get_current_user)):
     return {
         "message": "You accessed a protected endpoint!",
         "user": user["username"],
@@ -178,72 +274,158 @@ def protected_route(request: Request, user=Depends(get_current_user)):
 # ================================
 # MARKDOWN LESSON VIEWER
 # ================================
-@app.get("/", tags=["Lessons"], response_class=HTMLResponse)
-@limiter.limit("10/minute")
-def lesson_markdown_web(request: Request):
-    file_path = "lesson.md"
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Markdown file not found")
-
-    with open(file_path, "r", encoding="utf-8") as f:
-        md_content = f.read()
-
-    html_content = markdown.markdown(md_content, extensions=["fenced_code", "tables"])
-
-    full_html = f"""
+# Page shell is built once; only the rendered lesson body is substituted in.
+_PAGE_TEMPLATE = string.Template("""
     <html>
         <head>
             <title>Lesson</title>
             <style>
-                body {{ font-family: Arial, sans-serif; padding: 2rem; max-width: 800px; margin: auto; }}
-                pre {{ background-color: #f4f4f4; padding: 1rem; overflow-x: auto; }}
-                code {{ background-color: #f4f4f4; padding: 0.2rem 0.4rem; }}
-                h1, h2, h3 {{ color: #333; }}
+                body { font-family: Arial, sans-serif; padding: 2rem; max-width: 800px; margin: auto; }
+                pre { background-color: #f4f4f4; padding: 1rem; overflow-x: auto; }
+                code { background-color: #f4f4f4; padding: 0.2rem 0.4rem; }
+                h1, h2, h3 { color: #333; }
             </style>
         </head>
         <body>
-            {html_content}
+            $html
         </body>
     </html>
-    """
+    """)
+
+# Encoded page as (st_mtime_ns, body); re-rendered only when lesson.md changes.
+_md_cache: tuple[int, bytes] | None = None
 
+def _render_lesson(md_content: str) -> bytes:
+    html_content = markdown.markdown(md_content, extensions=["fenced_code", "tables"])
+    return _PAGE_TEMPLATE.substitute(html=html_content).encode("utf-8")
+
+@app.get("/", tags=["Lessons"], response_class=HTMLResponse)
+@limiter.limit("10/minute")
+async def lesson_markdown_web(request: Request):
+    global _md_cache
+    file_path = "lesson.md"
+    try:
+        mtime_ns = (await aiofiles.os.stat(file_path)).st_mtime_ns
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Markdown file not found")
+
+    if _md_cache is not None and _md_cache[0] == mtime_ns:
+        return HTMLResponse(content=_md_cache[1])
+
+    async with aiofiles.open(file_path, "r", encoding="utf-8") as f:
+        md_content = await f.read()
+
+    # Markdown parsing is pure Python, so render off the event loop.
+    full_html = await asyncio.to_thread(_render_lesson, md_content)
+
+    _md_cache = (mtime_ns, full_html)
     return HTMLResponse(content=full_html)
 
 # ================================
 # CHALLENGE MODE (RATE LIMITED)
 # ================================
 SECRET_NUMBERS = {"alpha": 7, "beta": 13, "gamma": 21}
-NONCES = {}
-KEYS = {}
+# "alpha-beta-gamma-" never changes, so only the nonce is appended per request.
+_HASH_PREFIX = f"{SECRET_NUMBERS['alpha']}-{SECRET_NUMBERS['beta']}-{SECRET_NUMBERS['gamma']}-".encode("ascii")
+# Nonces and keys live in Redis so every worker sees them and they expire on
+# their own. Values come back as bytes, ready for hmac.compare_digest.
+NONCE_TTL_SECONDS = 300
+KEY_TTL_SECONDS = 1800
+redis_client = aioredis.from_url(REDIS_URL, socket_connect_timeout=1)
+
+# Per-process fallback used while Redis is unreachable, mirroring the
+# limiter's in-memory fallback. Only touched from async endpoints on the loop.
+_local_nonces = TTLCache(maxsize=10000, ttl=NONCE_TTL_SECONDS)
+_local_keys = TTLCache(maxsize=10000, ttl=KEY_TTL_SECONDS)
+
+async def _state_set(name: str, value: str, ttl: int, local: TTLCache) -> None:
+    try:
+        await redis_client.set(name, value, ex=ttl)
+    except RedisError:
+        local[name] = value.encode()
+
+async def _state_get(name: str, local: TTLCache) -> bytes | None:
+    try:
+        return await redis_client.get(name)
+    except RedisError:
+        return local.get(name)
+
+async def _state_getdel(name: str, local: TTLCache) -> bytes | None:
+    try:
+        return await redis_client.getdel(name)
+    except RedisError:
+        return local.pop(name, None)
+
+# Nonces and keys are cut from one os.urandom call per pool fill instead of one
+# per request. Pools fill lazily inside each worker so forked processes never
+# share values, and are topped up on a worker thread below the low-water mark
+# (deque appends and pops are thread-safe).
+TOKEN_POOL_SIZE = 4096
+TOKEN_POOL_LOW_WATER = 512
+TOKEN_BYTES = 16
+_NONCE_POOL: deque[str] = deque()
+_KEY_POOL: deque[str] = deque()
+_pool_refills: dict[str, asyncio.Task] = {}
+
+def _hex_token(raw: bytes) -> str:
+    return raw.hex()
+
+def _urlsafe_token(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _fill_pool(pool: deque, encode) -> None:
+    raw = os.urandom(TOKEN_POOL_SIZE * TOKEN_BYTES)
+    pool.extend(encode(raw[i:i + TOKEN_BYTES]) for i in range(0, len(raw), TOKEN_BYTES))
+
+async def _refill_pool(pool: deque, encode) -> None:
+    await asyncio.to_thread(_fill_pool, pool, encode)
+
+def _take_token(name: str, pool: deque, encode) -> str:
+    if not pool:
+        _fill_pool(pool, encode)
+    elif len(pool) < TOKEN_POOL_LOW_WATER and name not in _pool_refills:
+        task = asyncio.create_task(_refill_pool(pool, encode))
+        _pool_refills[name] = task
+        task.add_done_callback(lambda _: _pool_refills.pop(name, None))
+    return pool.pop()
+
+# These responses never change, so they are encoded once at import.
+_CHALLENGE_INTRO_BYTES = orjson.dumps({
+    "challenge": "API Scavenger Hunt",
+    "instructions": [
+        "Find hidden endpoints.",
+        "Each endpoint returns a number.",
+        "Add all numbers together.",
+        "Send the result to /challenge/submit to win the prize."
+    ],
+    "hint": "Look for endpoints with Greek names 😉"
+})
+_ALPHA_BYTES = orjson.dumps({"value": SECRET_NUMBERS["alpha"]})
+_BETA_BYTES = orjson.dumps({"value": SECRET_NUMBERS["beta"]})
+_GAMMA_BYTES = orjson.dumps({"value": SECRET_NUMBERS["gamma"]})
 
 @app.get("/challenge", tags=["Challenge"])
 @limiter.limit("15/minute")
-def challenge_intro(request: Request):
-    return {
-        "challenge": "API Scavenger Hunt",
-        "instructions": [
-            "Find hidden endpoints.",
-            "Each endpoint returns a number.",
-            "Add all numbers together.",
-            "Send the result to /challenge/submit to win the prize."
-        ],
-        "hint": "Look for endpoints with Greek names 😉"
-    }
+async def challenge_intro(request: Request):
+    return Response(content=_CHALLENGE_INTRO_BYTES, media_type="application/json")
 
-@app.get("/challenge/alpha", tags=["Challenge"])
+# The number endpoints are plain Starlette routes: no dependency resolution or
+# response handling, just the rate limit and a pre-encoded body.
 @limiter.limit("10/minute")
-def challenge_alpha(request: Request):
-    return {"value": SECRET_NUMBERS["alpha"]}
+async def challenge_alpha(request: Request):
+    return Response(content=_ALPHA_BYTES, media_type="application/json")
 
-@app.get("/challenge/beta", tags=["Challenge"])
 @limiter.limit("10/minute")
-def challenge_beta(request: Request):
-    return {"value": SECRET_NUMBERS["beta"]}
+async def challenge_beta(request: Request):
+    return Response(content=_BETA_BYTES, media_type="application/json")
 
-@app.get("/challenge/gamma", tags=["Challenge"])
 @limiter.limit("10/minute")
-def challenge_gamma(request: Request):
-    return {"value": SECRET_NUMBERS["gamma"]}
+async def challenge_gamma(request: Request):
+    return Response(content=_GAMMA_BYTES, media_type="application/json")
+
+app.add_route("/challenge/alpha", challenge_alpha, methods=["GET"])
+app.add_route("/challenge/beta", challenge_beta, methods=["GET"])
+app.add_route("/challenge/gamma", challenge_gamma, methods=["GET"])
 
 class ChallengeSubmission(BaseModel):
     result: int
@@ -269,10 +451,10 @@ def challenge_submit(request: Request, data: ChallengeSubmission):
 
 @app.get("/challenge/key/start", tags=["Challenge"])
 @limiter.limit("5/minute")
-def challenge_key_start(request: Request):
+async def challenge_key_start(request: Request):
     ip = get_remote_address(request)
-    nonce = secrets.token_hex(16)
-    NONCES[ip] = nonce
+    nonce = _take_token("nonce", _NONCE_POOL, _hex_token)
+    await _state_set(f"nonce:{ip}", nonce, NONCE_TTL_SECONDS, _local_nonces)
     return {
         "step": "hash",
         "nonce": nonce,
@@ -281,16 +463,18 @@ def challenge_key_start(request: Request):
 
 @app.post("/challenge/key/hash", tags=["Challenge"])
 @limiter.limit("5/minute")
-def challenge_key_hash(request: Request, data: HashSubmission):
+async def challenge_key_hash(request: Request, data: HashSubmission):
     ip = get_remote_address(request)
-    if NONCES.get(ip) != data.nonce:
-        raise HTTPException(status_code=400, detail="Invalid or expired nonce")
-    s = f"{SECRET_NUMBERS['alpha']}-{SECRET_NUMBERS['beta']}-{SECRET_NUMBERS['gamma']}-{data.nonce}"
-    expected = hashlib.sha256(s.encode()).hexdigest()
-    if data.hash != expected:
+    nonce = data.nonce.encode()
+    expected = hashlib.sha256(_HASH_PREFIX + nonce).hexdigest()
+    if not hmac.compare_digest(data.hash.encode(), expected.encode()):
         raise HTTPException(status_code=400, detail="Incorrect hash")
-    key = secrets.token_urlsafe(16)
-    KEYS[ip] = key
+    # GETDEL consumes the nonce atomically, so it can only be exchanged once.
+    stored_nonce = await _state_getdel(f"nonce:{ip}", _local_nonces)
+    if not hmac.compare_digest(stored_nonce or b"", nonce):
+        raise HTTPException(status_code=400, detail="Invalid or expired nonce")
+    key = _take_token("key", _KEY_POOL, _urlsafe_token)
+    await _state_set(f"key:{ip}", key, KEY_TTL_SECONDS, _local_keys)
     return {
         "status": "OK",
         "next": "/challenge/prize",
@@ -300,9 +484,10 @@ def challenge_key_hash(request: Request, data: HashSubmission):
 
 @app.get("/challenge/prize", tags=["Challenge"])
 @limiter.limit("5/minute")
-def challenge_prize(request: Request, key: str | None = None):
+async def challenge_prize(request: Request, key: str | None = None):
     ip = get_remote_address(request)
-    if not key or KEYS.get(ip) != key:
+    stored_key = await _state_get(f"key:{ip}", _local_keys)
+    if not key or not hmac.compare_digest(stored_key or b"", key.encode()):
         raise HTTPException(status_code=403, detail="Valid key required")
     return {
         "prize": "API Master Badge",
@@ -312,17 +497,36 @@ def challenge_prize(request: Request, key: str | None = None):
 # ================================
 # HEALTH CHECK
 # ================================
+_ROOT_BYTES = orjson.dumps({
+    "status": "API running",
+    "docs": "/docs",
+    "lesson_flow": [
+        "1. GET /lessons",
+        "2. POST /token",
+        "3. GET /protected",
+        "4. POST /lessons (with token)",
+        "5. GET /challenge (scavenger hunt game)"
+    ]
+})
+
 @app.get("/listLessons", tags=["Lessons"])
 @limiter.limit("20/minute")
-def root(request: Request):
-    return {
-        "status": "API running",
-        "docs": "/docs",
-        "lesson_flow": [
-            "1. GET /lessons",
-            "2. POST /token",
-            "3. GET /protected",
-            "4. POST /lessons (with token)",
-            "5. GET /challenge (scavenger hunt game)"
-        ]
-    }
+async def root(request: Request):
+    return Response(content=_ROOT_BYTES, media_type="application/json")
+
+# ================================
+# OPENAPI
+# ================================
+_default_openapi = app.openapi
+
+def openapi_with_bearer():
+    # Protected routes no longer depend on oauth2_scheme, so register it here
+    # to keep the "Authorize" button in Swagger UI.
+    if app.openapi_schema is None:
+        schema = _default_openapi()
+        schema.setdefault("components", {}).setdefault("securitySchemes", {})[
+            oauth2_scheme.scheme_name
+        ] = jsonable_encoder(oauth2_scheme.model, by_alias=True, exclude_none=True)
+    return app.openapi_schema
+
+app.openapi = openapi_with_bearer